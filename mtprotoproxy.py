@@ -7,6 +7,7 @@ import urllib.request
 import collections
 import time
 import datetime
+import email.utils
 import hmac
 import base64
 import hashlib
@@ -80,6 +81,10 @@ MAX_MSG_LEN = 2 ** 24
 
 STAT_DURATION_BUCKETS = [0.1, 0.5, 1, 2, 5, 15, 60, 300, 600, 1800, 2**31 - 1]
 
+PROXY_REGEXP = re.compile(r"proxy_for\s+(-?\d+)\s+(.+):(\d+)\s*;")
+SECRET_REGEXP = re.compile(r"[0-9a-fA-F]{32}")
+NOT_HEX_REGEXP = re.compile(r"[^0-9a-fA-F]")
+
 my_ip_info = {"ipv4": None, "ipv6": None}
 used_handshakes = collections.OrderedDict()
 client_ips = collections.OrderedDict()
@@ -97,10 +102,12 @@ stats = collections.Counter()
 user_stats = collections.defaultdict(collections.Counter)
 
 config = {}
+user_secrets = {}
 
 
 def init_config():
     global config
+    global user_secrets
     # we use conf_dict to protect the original config from exceptions when reloading
     if len(sys.argv) < 2:
         conf_dict = runpy.run_module("config")
@@ -127,8 +134,8 @@ def init_config():
     conf_dict["AD_TAG"] = bytes.fromhex(conf_dict.get("AD_TAG", ""))
 
     for user, secret in conf_dict["USERS"].items():
-        if not re.fullmatch("[0-9a-fA-F]{32}", secret):
-            fixed_secret = re.sub(r"[^0-9a-fA-F]", "", secret).zfill(32)[:32]
+        if not SECRET_REGEXP.fullmatch(secret):
+            fixed_secret = NOT_HEX_REGEXP.sub("", secret).zfill(32)[:32]
 
             print_err("Bad secret for user %s, should be 32 hex chars, got %s. " % (user, secret))
             print_err("Changing it to %s" % fixed_secret)
@@ -295,6 +302,9 @@ def init_config():
     # allow access to config by attributes
     config = type("config", (dict,), conf_dict)(conf_dict)
 
+    # decode secrets once here, not on every client handshake
+    user_secrets = {user: bytes.fromhex(secret) for user, secret in config.USERS.items()}
+
 
 def apply_upstream_proxy_settings():
     # apply socks settings in place
@@ -431,12 +441,9 @@ def update_durations(duration):
 
 
 def get_curr_connects_count():
-    global user_stats
-
-    all_connects = 0
-    for user, stat in user_stats.items():
-        all_connects += stat["curr_connects"]
-    return all_connects
+    global stats
+    # maintained together with the per-user counters, summing them is slow with many users
+    return stats["curr_connects"]
 
 
 def get_to_tg_bufsize():
@@ -513,20 +520,22 @@ class TgConnectionPool:
         self.register_host_port(host, port, init_func)
 
         ret = None
-        for task in self.pools[(host, port, init_func)][::]:
+        pending_tasks = []
+        for task in self.pools[(host, port, init_func)]:
             if task.done():
                 if task.exception():
-                    self.pools[(host, port, init_func)].remove(task)
                     continue
 
                 reader, writer, *other = task.result()
                 if writer.transport.is_closing():
-                    self.pools[(host, port, init_func)].remove(task)
                     continue
 
                 if not ret:
-                    self.pools[(host, port, init_func)].remove(task)
                     ret = (reader, writer, *other)
+                    continue
+
+            pending_tasks.append(task)
+        self.pools[(host, port, init_func)] = pending_tasks
 
         self.register_host_port(host, port, init_func)
         if ret:
@@ -1117,10 +1126,9 @@ async def handle_fake_tls_handshake(handshake, reader, writer, peer):
     sess_id_len = handshake[SESSION_ID_LEN_POS]
     sess_id = handshake[SESSION_ID_POS:SESSION_ID_POS+sess_id_len]
 
-    for user in config.USERS:
-        secret = bytes.fromhex(config.USERS[user])
+    msg = handshake[:DIGEST_POS] + b"\x00"*DIGEST_LEN + handshake[DIGEST_POS+DIGEST_LEN:]
 
-        msg = handshake[:DIGEST_POS] + b"\x00"*DIGEST_LEN + handshake[DIGEST_POS+DIGEST_LEN:]
+    for user, secret in user_secrets.items():
         computed_digest = hmac.new(secret, msg, digestmod=hashlib.sha256).digest()
 
         xored_digest = bytes(digest[i] ^ computed_digest[i] for i in range(DIGEST_LEN))
@@ -1286,14 +1294,15 @@ async def handle_handshake(reader, writer):
         await handle_bad_client(reader, writer, handshake)
         return False
 
-    for user in config.USERS:
-        secret = bytes.fromhex(config.USERS[user])
+    dec_iv_int = int.from_bytes(dec_iv, "big")
+    enc_iv_int = int.from_bytes(enc_iv, "big")
 
+    for user, secret in user_secrets.items():
         dec_key = hashlib.sha256(dec_prekey + secret).digest()
-        decryptor = create_aes_ctr(key=dec_key, iv=int.from_bytes(dec_iv, "big"))
+        decryptor = create_aes_ctr(key=dec_key, iv=dec_iv_int)
 
         enc_key = hashlib.sha256(enc_prekey + secret).digest()
-        encryptor = create_aes_ctr(key=enc_key, iv=int.from_bytes(enc_iv, "big"))
+        encryptor = create_aes_ctr(key=enc_key, iv=enc_iv_int)
 
         decrypted = decryptor.decrypt(handshake)
 
@@ -1663,6 +1672,7 @@ async def handle_client(reader_clt, writer_clt):
     task_tg_to_clt = asyncio.ensure_future(tg_to_clt)
     task_clt_to_tg = asyncio.ensure_future(clt_to_tg)
 
+    update_stats(curr_connects=1)
     update_user_stats(user, curr_connects=1)
 
     tcp_limit_hit = (
@@ -1686,6 +1696,7 @@ async def handle_client(reader_clt, writer_clt):
         await asyncio.wait([task_tg_to_clt, task_clt_to_tg], return_when=asyncio.FIRST_COMPLETED)
         update_durations(time.time() - start)
 
+    update_stats(curr_connects=-1)
     update_user_stats(user, curr_connects=-1)
 
     task_tg_to_clt.cancel()
@@ -1826,34 +1837,37 @@ async def stats_printer():
     while True:
         await asyncio.sleep(config.STATS_PRINT_PERIOD)
 
-        print("Stats for", time.strftime("%d.%m.%Y %H:%M:%S"))
+        # collect the whole report and write it at once, there can be many users and ips
+        lines = []
+        lines.append("Stats for %s" % time.strftime("%d.%m.%Y %H:%M:%S"))
         for user, stat in user_stats.items():
-            print("%s: %d connects (%d current), %.2f MB, %d msgs" % (
+            lines.append("%s: %d connects (%d current), %.2f MB, %d msgs" % (
                 user, stat["connects"], stat["curr_connects"],
                 (stat["octets_from_client"] + stat["octets_to_client"]) / 1000000,
                 stat["msgs_from_client"] + stat["msgs_to_client"]))
-        print(flush=True)
+        lines.append("")
 
         if last_client_ips:
-            print("New IPs:")
-            for ip in last_client_ips:
-                print(ip)
-            print(flush=True)
+            lines.append("New IPs:")
+            lines.extend(last_client_ips)
+            lines.append("")
             last_client_ips.clear()
 
         if last_clients_with_time_skew:
-            print("Clients with time skew (possible replay-attackers):")
+            lines.append("Clients with time skew (possible replay-attackers):")
             for ip, skew_minutes in last_clients_with_time_skew.items():
-                print("%s, clocks were %d minutes behind" % (ip, skew_minutes))
-            print(flush=True)
+                lines.append("%s, clocks were %d minutes behind" % (ip, skew_minutes))
+            lines.append("")
             last_clients_with_time_skew.clear()
         if last_clients_with_same_handshake:
-            print("Clients with duplicate handshake (likely replay-attackers):")
+            lines.append("Clients with duplicate handshake (likely replay-attackers):")
             for ip, times in last_clients_with_same_handshake.items():
-                print("%s, %d times" % (ip, times))
-            print(flush=True)
+                lines.append("%s, %d times" % (ip, times))
+            lines.append("")
             last_clients_with_same_handshake.clear()
 
+        print("\n".join(lines), flush=True)
+
 
 async def make_https_req(url, host="core.telegram.org"):
     """ Make request, return resp body and headers. """
@@ -1994,7 +2008,8 @@ async def get_srv_time():
                 if not line.startswith(b"Date: "):
                     continue
                 line = line[len("Date: "):].decode()
-                srv_time = datetime.datetime.strptime(line, "%a, %d %b %Y %H:%M:%S %Z")
+                # the http date format is fixed, strptime is slow and depends on the locale
+                srv_time = email.utils.parsedate_to_datetime(line).replace(tzinfo=None)
                 now_time = datetime.datetime.utcnow()
                 is_time_skewed = (now_time-srv_time).total_seconds() > MAX_TIME_SKEW
                 if is_time_skewed and config.USE_MIDDLE_PROXY and not disable_middle_proxy:
@@ -2026,7 +2041,6 @@ async def clear_ip_resolving_cache():
 
 async def update_middle_proxy_info():
     async def get_new_proxies(url):
-        PROXY_REGEXP = re.compile(r"proxy_for\s+(-?\d+)\s+(.+):(\d+)\s*;")
         ans = {}
         headers, body = await make_https_req(url)
 